@@ -0,0 +1,17 @@
+#!/usr/bin/env python3
+"""
+Entrypoint that runs the Family Wellness web app under uvloop
+
+uvloop must be installed before Streamlit (Tornado) creates its event
+loop, so this has to happen ahead of any Streamlit import. Start with:
+
+    python run.py
+"""
+
+import uvloop
+uvloop.install()
+
+from streamlit.web import cli
+
+if __name__ == '__main__':
+    cli.main_run(['web_app.py'])
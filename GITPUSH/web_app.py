@@ -4,10 +4,29 @@ Family Wellness Web App using Streamlit
 Users provide their own Google API key
 """
 
+import datetime
+import hashlib
+import logging
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from dataclasses import dataclass, field
+from types import MappingProxyType
+
 import streamlit as st
-import google.generativeai as genai
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import os
 
+def _genai():
+    """Lazily import google.generativeai
+
+    The library drags in protobuf and gRPC - hundreds of ms and several MB
+    of RSS - which users sitting on the API-key setup screen never need.
+    Python caches the module, so calls after the first are a dict lookup.
+    """
+    import google.generativeai as genai
+    return genai
+
 # Configure page
 st.set_page_config(
     page_title="Family Wellness AI Platform",
@@ -17,52 +36,112 @@ st.set_page_config(
 )
 
 # AI Personalities
-PERSONALITIES = {
-    'sage': {
-        'name': '🧠 Sage',
-        'role': 'Youth Mental Health Counselor',
-        'description': 'For teenagers and young adults (mental health, academics)',
-        'prompt': """You are Sage, a supportive AI counselor for Indian youth aged 13-25. You understand academic pressure, family expectations, and cultural challenges. Always:
+@dataclass(frozen=True, slots=True)
+class Personality:
+    name: str
+    role: str
+    description: str
+    prompt: str
+    label: str = field(init=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, 'label', f"{self.name}\n{self.description}")
+
+PERSONALITIES = MappingProxyType({
+    'sage': Personality(
+        name='🧠 Sage',
+        role='Youth Mental Health Counselor',
+        description='For teenagers and young adults (mental health, academics)',
+        prompt="""You are Sage, a supportive AI counselor for Indian youth aged 13-25. You understand academic pressure, family expectations, and cultural challenges. Always:
 - Provide empathetic, non-judgmental support
 - Recognize signs of serious mental health concerns
 - Offer practical coping strategies rooted in Indian context
 - Bridge communication gaps between youth and families
 - Use encouraging, culturally sensitive language"""
-    },
-    'nurture': {
-        'name': '🤱 Nurture',
-        'role': 'Parenting Guide',
-        'description': 'For parents and guardians (parenting strategies)',
-        'prompt': """You are Nurture, an experienced parenting guide for Indian families. You understand diverse family structures, cultural values, and developmental science. Always:
+    ),
+    'nurture': Personality(
+        name='🤱 Nurture',
+        role='Parenting Guide',
+        description='For parents and guardians (parenting strategies)',
+        prompt="""You are Nurture, an experienced parenting guide for Indian families. You understand diverse family structures, cultural values, and developmental science. Always:
 - Provide evidence-based parenting strategies
 - Respect cultural traditions while promoting healthy development
 - Adapt advice for different socioeconomic contexts
 - Support parents' mental health and well-being
 - Offer practical, actionable guidance"""
-    },
-    'spark': {
-        'name': '✨ Spark',
-        'role': 'Child Development Specialist',
-        'description': 'For child development activities and learning',
-        'prompt': """You are Spark, a child development specialist creating engaging, age-appropriate activities. You understand Indian cultural contexts and diverse learning needs. Always:
+    ),
+    'spark': Personality(
+        name='✨ Spark',
+        role='Child Development Specialist',
+        description='For child development activities and learning',
+        prompt="""You are Spark, a child development specialist creating engaging, age-appropriate activities. You understand Indian cultural contexts and diverse learning needs. Always:
 - Design inclusive activities for all abilities
 - Incorporate cultural elements and local resources
 - Provide clear, step-by-step instructions
 - Suggest modifications for special needs
 - Make learning fun and engaging"""
-    },
-    'bridge': {
-        'name': '🌉 Bridge',
-        'role': 'Family Communication Mediator',
-        'description': 'For family communication and conflict resolution',
-        'prompt': """You are Bridge, a family communication specialist helping resolve conflicts and improve understanding. Always:
+    ),
+    'bridge': Personality(
+        name='🌉 Bridge',
+        role='Family Communication Mediator',
+        description='For family communication and conflict resolution',
+        prompt="""You are Bridge, a family communication specialist helping resolve conflicts and improve understanding. Always:
 - Remain neutral and understanding
 - Suggest practical communication strategies
 - Help different generations understand each other
 - Provide conflict resolution techniques
 - Support healthy family dynamics"""
-    }
-}
+    )
+})
+
+# Only replay the most recent messages each rerun; older ones stay in
+# session state but are not re-rendered and re-sent to the browser
+MAX_VISIBLE_MESSAGES = 30
+
+# Crisis detection. The phrase list will grow (regional languages, more
+# phrasings), so prefer a pyahocorasick automaton - a single O(len(message))
+# pass in C no matter how many phrases are registered - and fall back to the
+# compiled regex when the optional dependency isn't installed.
+CRISIS_KEYWORDS = frozenset({'suicide', 'kill myself', 'end it all', 'hurt myself', 'die', 'worthless'})
+try:
+    # RE2 (google-re2) scans in C with no Python-level iteration and no
+    # backtracking; the inline (?i) flag avoids the per-call message.lower() copy
+    import re2 as _re_backend
+except ImportError:
+    _re_backend = re
+CRISIS_RE = _re_backend.compile(
+    r"(?i)\b(?:" + "|".join(sorted(re.escape(keyword) for keyword in CRISIS_KEYWORDS)) + r")\b"
+)
+try:
+    import ahocorasick
+
+    CRISIS_AUTOMATON = ahocorasick.Automaton()
+    for keyword in CRISIS_KEYWORDS:
+        CRISIS_AUTOMATON.add_word(keyword.lower(), keyword)
+    CRISIS_AUTOMATON.make_automaton()
+except ImportError:
+    CRISIS_AUTOMATON = None
+
+# Optional on-disk response cache. Many prompts repeat across users
+# ("help with exam stress" and the like), so a hit answers in ~1 ms of
+# local disk read instead of a full Gemini round-trip. Opt-in via a
+# sidebar toggle since responses are normally non-deterministic.
+try:
+    import diskcache
+
+    RESPONSE_CACHE = diskcache.Cache('./.llm_cache')
+except ImportError:
+    RESPONSE_CACHE = None
+RESPONSE_CACHE_TTL = 7 * 86400  # seconds
+RESPONSE_CACHE_HISTORY = 6      # recent messages folded into the key
+
+def response_cache_key(personality_key, prompt):
+    """Key a response by personality, prompt, and the recent history tail"""
+    history_tail = "|".join(
+        m["content"] for m in st.session_state.messages[:-1][-RESPONSE_CACHE_HISTORY:]
+    )
+    raw = f"{personality_key}|{prompt}|{history_tail}"
+    return hashlib.blake2b(raw.encode()).hexdigest()
 
 # Initialize session state
 if 'messages' not in st.session_state:
@@ -75,14 +154,129 @@ if 'api_key_valid' not in st.session_state:
     st.session_state.api_key_valid = False
 if 'model' not in st.session_state:
     st.session_state.model = None
+if 'personality_caches' not in st.session_state:
+    st.session_state.personality_caches = {}
+if 'prewarm' not in st.session_state:
+    st.session_state.prewarm = {}
+if 'selected_model' not in st.session_state:
+    st.session_state.selected_model = None
+
+# Models (flash is ~an order of magnitude faster/cheaper than the legacy gemini-pro)
+MODEL_OPTIONS = ['gemini-1.5-flash-latest', 'gemini-1.5-pro-latest']
+DEFAULT_MODEL = MODEL_OPTIONS[0]
+FALLBACK_MODEL = 'gemini-pro'
+
+# Model used for cached personality prompts (context caching needs a pinned version).
+# The TTL must be a timedelta/int - the SDK rejects strings client-side.
+CACHE_MODEL = 'models/gemini-1.5-flash-001'
+CACHE_TTL = datetime.timedelta(hours=1)
+
+# Rough local token budget: fail fast instead of burning a network
+# round-trip on a request the model will reject for length. Estimating at
+# ~4 chars/token is close enough for a safety margin and keeps the
+# validation click free of extra count_tokens round-trips.
+MAX_CONTEXT_TOKENS = 30000
+TRIM_HISTORY_TO = 10
+BASE_TOKEN_ESTIMATES = {key: len(personality.prompt) // 4
+                        for key, personality in PERSONALITIES.items()}
+
+def trim_chat_history():
+    """Drop the oldest turns from both the display list and the live session
+
+    The API replays chat_session.history, not the display list, so that is
+    the one that has to shrink for the outgoing payload to get smaller.
+    """
+    st.session_state.messages = st.session_state.messages[-TRIM_HISTORY_TO:]
+    session = st.session_state.chat_session
+    if session is not None and len(session.history) > TRIM_HISTORY_TO:
+        tail = session.history[-TRIM_HISTORY_TO:]
+        # Keep the tail starting on a user turn so the roles still alternate
+        if tail and tail[0].role != 'user':
+            tail = tail[1:]
+        session.history = tail
+
+logger = logging.getLogger(__name__)
+_cache_failure_logged = False
+
+def _create_personality_cache(personality):
+    """Create one Gemini context cache (runs on a worker thread)
+
+    Note: the caching API enforces a minimum cacheable size (thousands of
+    tokens) that today's ~120-token prompts sit well below, so expect this
+    to return None and the inline-prompt fallback to carry the app until
+    the prompts grow past that floor.
+    """
+    global _cache_failure_logged
+    try:
+        cache = _genai().caching.CachedContent.create(
+            model=CACHE_MODEL,
+            system_instruction=personality.prompt,
+            ttl=CACHE_TTL
+        )
+        # One line per personality so a warm prewarm is visible in the logs
+        logger.info("Context cache created for %s", personality.name)
+        return cache
+    except Exception as e:
+        # Log the reason once per process instead of swallowing it; every
+        # personality fails the same way, so one line is enough
+        if not _cache_failure_logged:
+            _cache_failure_logged = True
+            logger.info("Context cache creation failed, using inline prompts: %s", e)
+        return None
+
+def prewarm_personality_caches():
+    """Kick off cache creation for all personalities in parallel"""
+    executor = ThreadPoolExecutor(max_workers=len(PERSONALITIES))
+    futures = {key: executor.submit(_create_personality_cache, personality)
+               for key, personality in PERSONALITIES.items()}
+    executor.shutdown(wait=False)
+    return futures
+
+def _get_personality_cache(personality_key):
+    """Resolve a personality's cache, collecting prewarm work when it's done"""
+    cache = st.session_state.personality_caches.get(personality_key)
+    if cache is not None:
+        return cache
+    future = st.session_state.prewarm.get(personality_key)
+    if future is not None:
+        try:
+            cache = future.result(timeout=0.1)
+        except FutureTimeoutError:
+            # Still warming; use the inline-prompt path for this session init.
+            # (Only an alias of the builtin TimeoutError from 3.11 on, so name
+            # the futures exception explicitly.)
+            return None
+        except Exception:
+            cache = None
+        del st.session_state.prewarm[personality_key]
+        st.session_state.personality_caches[personality_key] = cache
+    return cache
+
+@st.cache_resource(show_spinner=False)
+def _build_model(api_key, model_name=DEFAULT_MODEL):
+    """Configure the SDK and smoke-test a model for the given API key"""
+    genai = _genai()
+    genai.configure(api_key=api_key)
+    model = genai.GenerativeModel(model_name)
+    try:
+        # Test with a simple request
+        model.generate_content("Hi")
+    except Exception as e:
+        # Only fall back to the legacy model when the requested one doesn't exist
+        if '404' not in str(e) and 'not found' not in str(e).lower():
+            raise
+        model = genai.GenerativeModel(FALLBACK_MODEL)
+        model.generate_content("Hi")
+    return model
 
 def validate_api_key(api_key):
     """Validate Google API key"""
     try:
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel('gemini-pro')
-        # Test with a simple request
-        response = model.generate_content("Hello")
+        model = _build_model(api_key)
+        # configure() is process-global while the model cache is shared
+        # across sessions: rebind on every validation so a cache hit can't
+        # leave traffic billed to whichever key configured the client last
+        _genai().configure(api_key=api_key)
         return True, model
     except Exception as e:
         return False, str(e)
@@ -93,6 +287,18 @@ def initialize_chat_session(personality_key):
         return False
     
     personality = PERSONALITIES[personality_key]
+    cache = _get_personality_cache(personality_key)
+    if cache is not None:
+        try:
+            # Refresh the TTL lazily so an active session keeps its cache alive
+            cache.update(ttl=CACHE_TTL)
+            model = _genai().GenerativeModel.from_cached_content(cached_content=cache)
+            st.session_state.chat_session = model.start_chat(history=[])
+            return True
+        except Exception:
+            # Cache expired or was deleted server-side - recreate sessions without it
+            st.session_state.personality_caches[personality_key] = None
+
     st.session_state.chat_session = st.session_state.model.start_chat(
         history=[
             {
@@ -100,17 +306,61 @@ def initialize_chat_session(personality_key):
                 "parts": ["Hello, I need help with family wellness and development."]
             },
             {
-                "role": "model", 
-                "parts": [f"{personality['prompt']}\n\nHello! I'm {personality['name']}, your {personality['role']}. How can I support you today?"]
+                "role": "model",
+                "parts": [f"{personality.prompt}\n\nHello! I'm {personality.name}, your {personality.role}. How can I support you today?"]
             }
         ]
     )
     return True
 
+def _switch_personality_with_intro(personality_key):
+    """Initialize the new chat session and fetch its greeting concurrently
+
+    Both legs run the synchronous client on worker threads. The SDK caches
+    its async gRPC channel on whichever event loop first touches it, and a
+    per-click asyncio.run loop is closed on return, so the async client
+    raises "Event loop is closed" on every use after the first.
+    """
+    personality = PERSONALITIES[personality_key]
+    model_name = st.session_state.get('model_name', DEFAULT_MODEL)
+    ctx = get_script_run_ctx()
+
+    def _init_with_ctx():
+        # Worker threads have no ScriptRunContext, and without one every
+        # st.session_state access inside initialize_chat_session fails
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return initialize_chat_session(personality_key)
+
+    def _fetch_intro():
+        model = _genai().GenerativeModel(model_name)
+        response = model.generate_content(
+            f"{personality.prompt}\n\nGreet a new user in one or two warm sentences as {personality.name}, their {personality.role}."
+        )
+        return response.text
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        init_future = executor.submit(_init_with_ctx)
+        intro_future = executor.submit(_fetch_intro)
+        init_future.result()
+        return intro_future.result()
+
+def _is_word_char(ch):
+    """True for characters the regex \\b treats as word characters"""
+    return bool(ch) and (ch.isalnum() or ch == '_')
+
 def check_crisis_keywords(message):
     """Check for crisis keywords in user message"""
-    crisis_keywords = ['suicide', 'kill myself', 'end it all', 'hurt myself', 'die', 'worthless']
-    return any(keyword in message.lower() for keyword in crisis_keywords)
+    if CRISIS_AUTOMATON is not None:
+        lowered = message.lower()
+        for end, keyword in CRISIS_AUTOMATON.iter(lowered):
+            # The automaton matches raw substrings, so verify word boundaries
+            # here - otherwise 'die' fires inside 'studied' and the primary
+            # and regex-fallback paths disagree on what counts as a crisis
+            start = end - len(keyword) + 1
+            if not _is_word_char(lowered[start - 1:start]) and not _is_word_char(lowered[end + 1:end + 2]):
+                return True
+        return False
+    return CRISIS_RE.search(message) is not None
 
 def get_crisis_response():
     """Return crisis response"""
@@ -124,6 +374,35 @@ def get_crisis_response():
 
 You don't have to face this alone. Would you like to talk about what's making you feel this way?"""
 
+# Static blocks: rendering these as fragments keeps normal reruns (every
+# keystroke, every widget change) from re-rendering and re-sending them
+@st.fragment
+def _crisis_resources():
+    with st.expander("🆘 Crisis Resources"):
+        st.markdown("""
+        **India:**
+        - Suicide Prevention: 104
+        - KIRAN Mental Health: 1800-599-0019
+        - Vandrevala Foundation: 9999666555
+        - iCall: 9152987821
+
+        **Emergency:**
+        - Police: 100
+        - Ambulance: 108
+        - Women Helpline: 181
+        """)
+
+@st.fragment
+def _footer():
+    st.markdown("---")
+    st.markdown("""
+<div style='text-align: center; color: gray;'>
+    <p>🌟 Family Wellness & Development Platform | Users Provide Their Own API Keys</p>
+    <p>🔐 Your API key is secure and only used during your session</p>
+    <p>Remember: Taking care of your family's mental health is a journey, not a destination.</p>
+</div>
+""", unsafe_allow_html=True)
+
 # Main app
 st.title("🏠 Family Wellness AI Platform")
 st.markdown("*Powered by Google Gemini AI - Bring Your Own API Key*")
@@ -161,6 +440,9 @@ if not st.session_state.api_key_valid:
                 if is_valid:
                     st.session_state.api_key_valid = True
                     st.session_state.model = result
+                    # Fire-and-forget: caches warm in parallel while the
+                    # user reads the success message and picks a personality
+                    st.session_state.prewarm = prewarm_personality_caches()
                     st.success("✅ API key validated successfully!")
                     st.rerun()
                 else:
@@ -187,12 +469,9 @@ with col1:
     st.header("🤖 AI Assistants")
     
     # Personality selection
-    personality_options = {key: f"{value['name']}\n{value['description']}" 
-                          for key, value in PERSONALITIES.items()}
-    
     for key, personality in PERSONALITIES.items():
         if st.button(
-            f"{personality['name']}\n{personality['description']}", 
+            personality.label,
             key=key,
             use_container_width=True
         ):
@@ -203,7 +482,30 @@ with col1:
                 st.rerun()
     
     st.markdown("---")
-    
+
+    # Model selection (re-instantiating is local and cheap; no network call).
+    # Compare against the last *selected* name, not model.model_name: after a
+    # 404 fallback the live model is gemini-pro on purpose, and comparing
+    # against it would swap the known-broken flash model back in every rerun.
+    model_name = st.selectbox("Model:", MODEL_OPTIONS, key="model_name")
+    if st.session_state.selected_model is None:
+        st.session_state.selected_model = model_name
+    elif st.session_state.selected_model != model_name:
+        st.session_state.selected_model = model_name
+        if st.session_state.model is not None:
+            st.session_state.model = _genai().GenerativeModel(model_name)
+            st.session_state.messages = []
+            st.session_state.chat_session = None
+
+    if RESPONSE_CACHE is not None:
+        st.toggle(
+            "Use response cache",
+            key="use_response_cache",
+            help="Reuse saved answers for repeated questions (faster, but less varied)."
+        )
+
+    st.markdown("---")
+
     # Quick Assessment
     with st.expander("📊 Quick Assessment"):
         age_group = st.selectbox("Age Group:", 
@@ -227,25 +529,21 @@ with col1:
                 st.session_state.personality = rec_personality
                 st.session_state.messages = []
                 st.session_state.chat_session = None
-                st.success(f"Switched to {PERSONALITIES[rec_personality]['name']}")
+                try:
+                    # Overlap the session init with fetching the greeting,
+                    # so the switch costs max() of the two, not the sum
+                    intro = _switch_personality_with_intro(rec_personality)
+                    st.session_state.messages.append({"role": "assistant", "content": intro})
+                except Exception:
+                    # The chat column falls back to the default greeting
+                    st.session_state.chat_session = None
+                st.success(f"Switched to {PERSONALITIES[rec_personality].name}")
                 st.rerun()
     
     st.markdown("---")
-    
+
     # Crisis Resources
-    with st.expander("🆘 Crisis Resources"):
-        st.markdown("""
-        **India:**
-        - Suicide Prevention: 104
-        - KIRAN Mental Health: 1800-599-0019
-        - Vandrevala Foundation: 9999666555
-        - iCall: 9152987821
-        
-        **Emergency:**
-        - Police: 100
-        - Ambulance: 108
-        - Women Helpline: 181
-        """)
+    _crisis_resources()
     
     # Clear chat
     if st.button("🗑️ Clear Chat", use_container_width=True):
@@ -265,23 +563,23 @@ with col1:
 with col2:
     current_personality = PERSONALITIES[st.session_state.personality]
     
-    st.subheader(f"💬 Chat with {current_personality['name']}")
-    st.caption(f"Your {current_personality['role']}")
+    st.subheader(f"💬 Chat with {current_personality.name}")
+    st.caption(f"Your {current_personality.role}")
     
     # Initialize chat session if needed
     if st.session_state.chat_session is None:
         if initialize_chat_session(st.session_state.personality):
             st.session_state.messages.append({
                 "role": "assistant", 
-                "content": f"Hello! I'm {current_personality['name']}, your {current_personality['role']}. How can I support you today?"
+                "content": f"Hello! I'm {current_personality.name}, your {current_personality.role}. How can I support you today?"
             })
     
     # Chat container
     chat_container = st.container(height=400)
     
     with chat_container:
-        # Display chat messages
-        for message in st.session_state.messages:
+        # Display chat messages (recent window only, to keep rerun cost flat)
+        for message in st.session_state.messages[-MAX_VISIBLE_MESSAGES:]:
             with st.chat_message(message["role"]):
                 st.write(message["content"])
     
@@ -293,35 +591,49 @@ with col2:
                 st.write(prompt)
         st.session_state.messages.append({"role": "user", "content": prompt})
         
-        # Check for crisis keywords
-        if check_crisis_keywords(prompt):
-            response = get_crisis_response()
-        else:
-            # Generate AI response
-            try:
-                with st.spinner("Thinking..."):
-                    context_prompt = f"""As {current_personality['name']}, a {current_personality['role']}, respond to: {prompt}
-                    
-                    Remember: {current_personality['prompt']}"""
-                    
-                    ai_response = st.session_state.chat_session.send_message(context_prompt)
-                    response = ai_response.text
-            except Exception as e:
-                response = f"I apologize, but I encountered an error: {str(e)}. Please try again."
-        
         # Display AI response
         with chat_container:
             with st.chat_message("assistant"):
-                st.write(response)
+                # Check for crisis keywords
+                if check_crisis_keywords(prompt):
+                    response = get_crisis_response()
+                    st.write(response)
+                else:
+                    # Estimate the request size locally and keep it inside the
+                    # budget rather than letting the API reject it
+                    base_tokens = BASE_TOKEN_ESTIMATES.get(st.session_state.personality, 0)
+                    user_tokens = len(prompt) // 4
+                    history_tokens = sum(len(m["content"]) for m in st.session_state.messages) // 4
+                    if base_tokens + user_tokens > MAX_CONTEXT_TOKENS:
+                        # No amount of history trimming makes this fit; skip the call
+                        response = "⚠️ That message is too long for me to process. Please shorten it and send it again."
+                        st.write(response)
+                    else:
+                        if base_tokens + history_tokens + user_tokens > MAX_CONTEXT_TOKENS:
+                            trim_chat_history()
+                            st.warning("This conversation got very long, so older messages were trimmed to stay within the model's limit.")
+
+                        cache_key = None
+                        if RESPONSE_CACHE is not None and st.session_state.get('use_response_cache'):
+                            cache_key = response_cache_key(st.session_state.personality, prompt)
+
+                        if cache_key is not None and cache_key in RESPONSE_CACHE:
+                            response = RESPONSE_CACHE[cache_key]
+                            st.write(response)
+                        else:
+                            # Generate AI response, streaming tokens as they arrive.
+                            # The personality is already established in the session
+                            # (cached content or seeded history), so send the user
+                            # message as-is rather than re-wrapping it every turn.
+                            try:
+                                stream = st.session_state.chat_session.send_message(prompt, stream=True)
+                                response = st.write_stream(chunk.text for chunk in stream)
+                                if cache_key is not None:
+                                    RESPONSE_CACHE.set(cache_key, response, expire=RESPONSE_CACHE_TTL)
+                            except Exception as e:
+                                response = f"I apologize, but I encountered an error: {str(e)}. Please try again."
+                                st.write(response)
         st.session_state.messages.append({"role": "assistant", "content": response})
-        st.rerun()
 
 # Footer
-st.markdown("---")
-st.markdown("""
-<div style='text-align: center; color: gray;'>
-    <p>🌟 Family Wellness & Development Platform | Users Provide Their Own API Keys</p>
-    <p>🔐 Your API key is secure and only used during your session</p>
-    <p>Remember: Taking care of your family's mental health is a journey, not a destination.</p>
-</div>
-""", unsafe_allow_html=True)
\ No newline at end of file
+_footer()
\ No newline at end of file